@@ -2,12 +2,24 @@ import traceback
 import json
 import os
 import hashlib
+import mmap
+import pickle
+import re
+import subprocess
+import sys
+import tempfile
 from pathlib import Path
 import boto3
+from boto3.s3.transfer import TransferConfig
 import time
+from array import array
+from bisect import bisect_right
+from collections import defaultdict
 import threading
+from concurrent.futures import ThreadPoolExecutor
 
 from flask import send_from_directory, Response
+from patmatch_to_nrgrep import convert_pattern
 
 MAX_BUFFER_SIZE = 1600000
 MIN_TOKEN = 3
@@ -19,23 +31,75 @@ binDir = '/var/www/bin/'
 dataDir = '/data/patmatch/'
 tmpDir = '/var/www/tmp/'
 config_dir = '/var/www/conf/'
-seqIndexCreateScript = binDir + 'generate_sequence_index.pl'
-patternConvertScript = binDir + 'patmatch_to_nrgrep.pl'
 searchScript = binDir + 'nrgrep_coords'
 day = 1  ## delete temp files that are one day old
+invalidNucChars = frozenset('EFIJLOPQZ')
+tokenPattern = re.compile(r'[\[\{\(][^\]\}\)]*[\]\}\)]?|[^\[\{\(\]\}\)]')
+headerLinePattern = re.compile(rb'^>(\S+)', re.M)
+hitLinePattern = re.compile(rb'\[(\d+),\s*(\d+)\]:?\s*(\S*)')
+cleanupInterval = 3600  ## sweep tmpDir at most once an hour
+_last_cleanup = 0
+## parsed data files keyed by (loader, path); each entry remembers the
+## mtime/size it was built from so a new data release is picked up
+_file_cache = {}
+
+## bump when the layout of a pickled index changes so stale sidecars are rebuilt
+indexFormat = 2
+
+## boto3 clients are thread-safe, so one is shared by all uploads; large
+## result files are sent as concurrent multipart uploads
+MB = 1024 * 1024
+s3TransferConfig = TransferConfig(multipart_threshold=8*MB, multipart_chunksize=8*MB,
+                                  max_concurrency=10, use_threads=True)
+_s3_client = None
+_s3_client_lock = threading.Lock()
+
+## uploads run on a fixed pool of worker threads instead of one new thread each
+maxUploadWorkers = 8
+_s3_upload_pool = ThreadPoolExecutor(max_workers=maxUploadWorkers, thread_name_prefix='s3up')
 
 def set_download_file(filename):
 
     return send_from_directory(tmpDir, filename, as_attachment=True, mimetype='application/text', attachment_filename=(str(filename)))
 
 def clean_up_temp_files():
-    
+
+    global _last_cleanup
     now = time.time()
-    for f in os.listdir(tmpDir):
-        file = os.path.join(tmpDir, f)
-        if os.stat(file).st_mtime < now - day * 86400:
-            if os.path.isfile(file):
-                os.remove(file)
+    if now - _last_cleanup < cleanupInterval:
+        return
+    _last_cleanup = now
+
+    cutoff = now - day * 86400
+    with os.scandir(tmpDir) as entries:
+        for entry in entries:
+            try:
+                ## scandir entries cache their stat and file type, so each file
+                ## costs at most one extra syscall
+                if entry.stat(follow_symlinks=False).st_mtime >= cutoff:
+                    continue
+                if entry.is_file(follow_symlinks=False):
+                    os.remove(entry.path)
+                elif entry.is_dir(follow_symlinks=False) and not os.listdir(entry.path):
+                    os.rmdir(entry.path)
+            except OSError:
+                continue
+
+def schedule_temp_file_cleanup(delay=cleanupInterval):
+
+    def run():
+        try:
+            clean_up_temp_files()
+        except Exception as e:
+            print("Error cleaning up temp files:", e)
+        schedule_temp_file_cleanup()
+
+    timer = threading.Timer(delay, run)
+    timer.daemon = True
+    timer.start()
+
+## temp files are swept on a timer instead of after every upload
+schedule_temp_file_cleanup(delay=0)
 
 def upload_file_to_s3_async(file, filename):
     """
@@ -48,15 +112,22 @@ def upload_file_to_s3_async(file, filename):
     finally:
         file.close()
 
+def get_s3_client():
+
+    global _s3_client
+    with _s3_client_lock:
+        if _s3_client is None:
+            _s3_client = boto3.client('s3')
+    return _s3_client
+
 def upload_file_to_s3(file, filename):
 
     filename = 'patmatch/' + filename
     
     S3_BUCKET = os.environ['S3_BUCKET']
-    s3 = boto3.client('s3')
+    s3 = get_s3_client()
     file.seek(0)
-    s3.upload_fileobj(file, S3_BUCKET, filename, ExtraArgs={'ACL': 'public-read'})
-    clean_up_temp_files()
+    s3.upload_fileobj(file, S3_BUCKET, filename, ExtraArgs={'ACL': 'public-read'}, Config=s3TransferConfig)
     return "https://" + S3_BUCKET + ".s3.amazonaws.com/" + filename
               
 def get_downloadUrl(tmpFile):
@@ -64,8 +135,11 @@ def get_downloadUrl(tmpFile):
     downloadFile = tmpDir + tmpFile
     thisFile = Path(str(downloadFile))
     md5sum = None
+    md5 = hashlib.md5()
     with thisFile.open(mode="rb") as fh:
-        md5sum = hashlib.md5(fh.read()).hexdigest()
+        for chunk in iter(lambda: fh.read(1<<20), b''):
+            md5.update(chunk)
+    md5sum = md5.hexdigest()
     newFileName = downloadFile
     if md5sum:
         tmpFile = md5sum + ".txt"
@@ -76,9 +150,8 @@ def get_downloadUrl(tmpFile):
        
     # s3_url = upload_file_to_s3(file, tmpFile)
 
-    # Start a new thread for file upload
-    thread = threading.Thread(target=upload_file_to_s3_async, args=(file, tmpFile))
-    thread.start()
+    # Hand the upload to the background upload pool
+    _s3_upload_pool.submit(upload_file_to_s3_async, file, tmpFile)
 
     # Return the expected S3 URL immediately
     S3_BUCKET = os.environ['S3_BUCKET']
@@ -91,56 +164,135 @@ def get_config(conf):
         conf = 'patmatch'
     if not conf.endswith('.json'):
         conf = conf + '.json'
-    f = open(config_dir + conf, encoding="utf-8")
-    data = ''
-    for line in f:
-        data = data + line.strip()
-    f.close()
-    return json.loads(data)
+    conffile = resolve_path(config_dir, config_dir + conf)
+    if conffile is None:
+        return { "error": "Unknown config: " + conf }
+    return load_cached(load_config, conffile)
+
+def resolve_path(baseDir, path):
+
+    ## paths come from the request, so every spelling of a file is collapsed
+    ## to one normalized path (one cache entry per file) and anything outside
+    ## baseDir is refused; symlinks inside baseDir are left alone
+    path = os.path.normpath(os.path.abspath(path))
+    baseDir = os.path.normpath(os.path.abspath(baseDir))
+    if os.path.commonpath([path, baseDir]) != baseDir:
+        return None
+    return path
+
+def load_config(conffile):
+
+    with open(conffile, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def load_cached(loader, datafile):
+
+    st = os.stat(datafile)
+    stamp = (st.st_mtime_ns, st.st_size)
+    key = (loader, datafile)
+    cached = _file_cache.get(key)
+    if cached is not None and cached[0] == stamp:
+        return cached[1]
+    data = loader(datafile)
+    _file_cache[key] = (stamp, data)
+    return data
 
 
 def get_record_offset(datafile):
 
-    recordOffSetList = []
-    seqNm4offSet = {}
-    
-    cmd = seqIndexCreateScript + " < " + datafile 
+    return load_cached(load_record_offset, datafile)
+
+
+def load_record_offset(datafile):
 
-    out = os.popen(cmd).read()
+    return load_index_file(build_record_offset, datafile, datafile + ".offsets.idx.pkl")
+
+
+def build_record_offset(datafile):
+
+    ## one regex pass over the mapped file gives the same offsets that
+    ## generate_sequence_index.pl prints: the start of each header (named
+    ## '>name') and the start of the sequence that follows it
+    ## offsets are kept as a flat int64 array for the per-hit bisect, with
+    ## the name for each offset at the same position in seqNmList
+    recordOffSetList = array('q')
+    seqNmList = []
     
-    for line in out.split('\n'):
-        pieces = line.strip().split('\t')
-        if len(pieces) < 2:
-            continue
-        offSet = int(pieces[0])
-        seqNm = pieces[1]
-        recordOffSetList.append(offSet)
-        seqNm4offSet[offSet] = seqNm
+    with open(datafile, "rb") as fh:
+        size = os.fstat(fh.fileno()).st_size
+        if size == 0:
+            return (recordOffSetList, seqNmList)
+        mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            for m in headerLinePattern.finditer(mm):
+                seqNm = sys.intern(m.group(1).decode())
+                hdrOffSet = m.start()
+                lineEnd = mm.find(b'\n', m.end())
+                seqOffSet = lineEnd + 1 if lineEnd != -1 else size
+                recordOffSetList.append(hdrOffSet)
+                seqNmList.append('>' + seqNm)
+                recordOffSetList.append(seqOffSet)
+                seqNmList.append(seqNm)
+        finally:
+            mm.close()
         
-    return (recordOffSetList, seqNm4offSet)
-
-
-def get_name_offset(offSet, recordOffSetList):
-
-    ### perform binary search                                                                          
-    low = 0
-    high = len(recordOffSetList) - 1
-    while high > low:
-        ### pre-condition: offSet is in recordOffSetList[$low .. $high]
-        middle = int((low+high)/2)
-        if recordOffSetList[middle] == offSet:
-            return offSet
-        elif high - low == 1:
-            if offSet >= recordOffSetList[high]:
-                return recordOffSetList[high]
+    return (recordOffSetList, seqNmList)
+
+
+def run_search(commands):
+
+    ## start all searches right away so both strands are scanned concurrently,
+    ## and while the caller loads its record offsets; the first one is
+    ## streamed through a pipe, the others are spooled to unnamed temp files
+    ## so they never stall on a full pipe buffer
+    procs = []
+    try:
+        for args in commands:
+            if procs:
+                spool = tempfile.TemporaryFile()
+                procs.append((subprocess.Popen(args, stdout=spool), spool))
+            else:
+                procs.append((subprocess.Popen(args, stdout=subprocess.PIPE, bufsize=1<<20), None))
+    except BaseException:
+        stop_search(procs)
+        raise
+    output = read_search_output(procs)
+    ## advance to the first yield so closing output always stops the searches,
+    ## even if the caller never reads from it
+    next(output)
+    return output
+
+
+def read_search_output(procs):
+
+    try:
+        yield
+        for (proc, spool) in procs:
+            if spool is None:
+                stream = proc.stdout
             else:
-                return recordOffSetList[low]
-        elif recordOffSetList[middle] < offSet:
-            low = middle
-        elif recordOffSetList[middle] > offSet:
-            high = middle - 1
+                proc.wait()
+                spool.seek(0)
+                stream = spool
+            for line in stream:
+                yield line
+    finally:
+        stop_search(procs)
+
 
-    return recordOffSetList[low]
+def stop_search(procs):
+
+    ## the caller may stop early (maxhits), so don't wait on searches
+    ## that are still running
+    for (proc, spool) in procs:
+        if proc.poll() is None:
+            proc.terminate()
+        if spool is None:
+            proc.stdout.close()
+        else:
+            spool.close()
+        proc.wait()
                      
             
 def check_pattern(pattern, seqtype):
@@ -149,28 +301,20 @@ def check_pattern(pattern, seqtype):
         if 'u' in pattern.lower():
             return 'Invalid peptide character found in pattern.'
     else:
-        if any(x in pattern.upper() for x in ('E', 'F', 'I', 'J', 'L', 'O', 'P', 'Q', 'Z')):
+        if not invalidNucChars.isdisjoint(pattern.upper()):
             return 'Invalid nucleotide character found in pattern.'
 
-    tokens = 0
-    countingMode = 1
-    for x in pattern:
-        if x in ['(', '[', '{']:
-            if countingMode:
-                tokens = tokens + 1
-            countingMode = 0
-        elif x in [')', ']', '}']:
-            countingMode = 1
-        elif countingMode:
-            tokens = tokens + 1
-
-    if '{' in pattern or '{' in pattern:
+    ## a bracketed group counts as one residue, everything else outside
+    ## brackets as one each
+    tokens = len(tokenPattern.findall(pattern))
+
+    if '{' in pattern or '}' in pattern:
         return ''
 
     if tokens < MIN_TOKEN:
         return "Your pattern is shorter than the minimum number of " + str(MIN_TOKEN) + " residues."
     return ''
-    
+
 def process_pattern(pattern, seqtype, strand, insertion, deletion, substitution, mismatch):
 
     mismatch_option = ""
@@ -192,13 +336,11 @@ def process_pattern(pattern, seqtype, strand, insertion, deletion, substitution,
     else:
         option = '-n'
         
-    cmd = patternConvertScript + " " + option + " '" + pattern + "'"
-    pattern = os.popen(cmd).read()
+    pattern = convert_pattern(option, pattern)
     
     comp_pattern = ""    
     if seqtype.lower() in ['dna', 'nuc'] and (strand is None or strand.startswith('Both')):
-        cmd2 = patternConvertScript + " -c " + "'" + pattern + "'"
-        comp_pattern = os.popen(cmd2).read()
+        comp_pattern = convert_pattern('-c', pattern)
     
     if insertion and insertion.startswith('insertion'): 
         mismatch_option = mismatch_option + 'i'
@@ -220,31 +362,96 @@ def process_pattern(pattern, seqtype, strand, insertion, deletion, substitution,
     return (pattern, comp_pattern, mismatch_option)
 
 
+def build_seq_index(datafile):
+
+    ## map each lower-cased sequence name to its defline and the byte range
+    ## of its residues, in file order
+    index = {}
+    entry = None
+    offset = 0
+    with open(datafile, "rb") as f:
+        for line in f:
+            if line.startswith(b'>'):
+                if entry is not None:
+                    entry[2] = offset
+                defline = line.strip().decode()
+                entry = [defline, offset + len(line), offset + len(line)]
+                pieces = defline[1:].split()
+                if pieces:
+                    index.setdefault(pieces[0].lower(), entry)
+            offset = offset + len(line)
+    if entry is not None:
+        entry[2] = offset
+    return index
+
+
+def load_seq_index(datafile):
+
+    return load_index_file(build_seq_index, datafile, datafile + ".idx.pkl")
+
+
+def load_index_file(builder, datafile, idxfile):
+
+    ## indexes are pickled next to the sequence file so a fresh process can
+    ## load them instead of rescanning, and are rebuilt when the file changes
+    mtime = os.stat(datafile).st_mtime_ns
+    try:
+        with open(idxfile, "rb") as f:
+            (idxFormat, idxMtime, index) = pickle.load(f)
+        if idxFormat == indexFormat and idxMtime == mtime:
+            return index
+    except (OSError, EOFError, TypeError, ValueError, pickle.UnpicklingError):
+        pass
+
+    ## each writer gets its own temp file, so concurrent rebuilds in one
+    ## process never publish each other's half-written pickle
+    index = builder(datafile)
+    tmpIdxFile = None
+    try:
+        (fd, tmpIdxFile) = tempfile.mkstemp(prefix=os.path.basename(idxfile) + ".",
+                                            dir=os.path.dirname(idxfile))
+        with os.fdopen(fd, "wb") as f:
+            pickle.dump((indexFormat, mtime, index), f, pickle.HIGHEST_PROTOCOL)
+        os.chmod(tmpIdxFile, 0o644)
+        os.replace(tmpIdxFile, idxfile)
+    except OSError:
+        if tmpIdxFile is not None:
+            try:
+                os.remove(tmpIdxFile)
+            except OSError:
+                pass
+    return index
+
+
 def get_sequence(dataset, seqname):
 
     if '.seq' not in dataset:
         dataset = dataset + ".seq"
     if 'patmatch' not in dataset:
         dataset = dataDir + dataset
-    f = open(dataset, encoding="utf-8")
-    
-    found = 0
+    dataset = resolve_path(dataDir, dataset)
+    if dataset is None:
+        return { 'defline': '',
+                 'seq': '' }
+
+    index = load_cached(load_seq_index, dataset)
+
+    seqname = seqname.lower()
+    entry = index.get(seqname)
+    if entry is None:
+        ## fall back to matching the start of the defline
+        for thisEntry in index.values():
+            if thisEntry[0].lower().startswith('>' + seqname):
+                entry = thisEntry
+                break
+
     seq = ""
     defline = ""
-
-    for line in f:
-        line = line.strip()
-        if line.lower().startswith('>'+seqname.lower()):
-            found = 1
-            defline = line
-            continue
-        if found == 0:
-            continue
-        if found == 1 and line.startswith('>'):
-            break
-        seq = seq + line
-    
-    f.close()
+    if entry is not None:
+        (defline, beg, end) = entry
+        with open(dataset, "rb") as f:
+            f.seek(beg)
+            seq = f.read(end - beg).translate(None, b" \t\r\n").decode()
 
     defline = defline.replace('"', "'")
 
@@ -281,69 +488,100 @@ def cleanup_pattern(pattern):
     
     return pattern
 
-def set_seq_length(seqNm2length, datafile):
-
-    f = open(datafile, encoding="utf-8")
-    seq = ''
-    preSeqNm = ''
-    for line in f:
-        if line.startswith('>'):
-            seqNm = line.replace('>', '').split(' ')[0]
-            if preSeqNm != '':
-                if seq.endswith('*'):
-                    seq = seq.rstrip(seq[-1])
-                seqNm2length[preSeqNm] = len(seq)
-            preSeqNm = seqNm
-            seq = ''
-        else:
-            seq = seq + line.strip()
-            
-    if preSeqNm != '' and seq != '':
-        if seq.endswith('*'):
-            seq = seq.rstrip(seq[-1])
-        seqNm2length[preSeqNm] = len(seq)
-    f.close()
+def load_seq_length(datafile):
+
+    return load_index_file(build_seq_length, datafile, datafile + ".lengths.idx.pkl")
+
+def build_seq_length(datafile):
+
+    ## work on the raw bytes so the per-record counting runs in C instead of
+    ## building every sequence string line by line
+    seqNm2length = {}
+    with open(datafile, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return seqNm2length
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            size = len(mm)
+            start = 0
+            if mm[:1] != b'>':
+                start = mm.find(b'\n>')
+                if start != -1:
+                    start = start + 1
+            while start != -1:
+                hdrEnd = mm.find(b'\n', start)
+                if hdrEnd == -1:
+                    hdrEnd = size
+                nextHdr = mm.find(b'\n>', hdrEnd)
+                seqEnd = nextHdr + 1 if nextHdr != -1 else size
+                seqNm = mm[start+1:hdrEnd].strip().split(b' ')[0].decode()
+                region = mm[hdrEnd:seqEnd]
+                length = len(region) - sum(region.count(c) for c in (b'\n', b'\r', b' ', b'\t'))
+                ## a trailing '*' marks the stop codon in peptide files
+                tail = region[-256:].translate(None, b' \t\r\n')
+                length = length - (len(tail) - len(tail.rstrip(b'*')))
+                seqNm2length[seqNm] = length
+                start = seqEnd if nextHdr != -1 else -1
+        finally:
+            mm.close()
+    return seqNm2length
+
+def load_locus_data(locusfile):
+
+    name2data = {}
+    with open(locusfile, encoding="utf-8") as f:
+        for line in f:
+            pieces = line.strip().split('\t')
+            seqName = pieces[0]
+            geneName = pieces[1]
+            sgdid = pieces[2]
+            desc = ''
+            if len(pieces) > 3:
+                desc = pieces[3]
+            name2data[seqName] = (geneName, sgdid, desc)
+    return name2data
+
+def load_not_feature_data(datafile):
+
+    seqNm2chr = {}
+    seqNm2orfs = {}
+    with open(datafile, encoding="utf-8") as f:
+        for line in f:
+            if line.startswith('>'):
+                # >A:2170-2479, Chr I from 2170-2479, Genome Release 64-3-1, between YAL068C and YAL067W-A
+                # /^>([^ ]+)\, Chr ([^ ]+) from .+ between ([^ ]+ and [^ ]+)/)
+                pieces = line.strip().replace('>', '').split(' ')
+                seqName = pieces[0].replace(',', '')
+                chr = pieces[2]
+                orfs = line.strip().split('between ')[1]
+                seqNm2chr[seqName] = chr
+                orfs = orfs.replace('and', '-')
+                seqNm2orfs[seqName] = orfs;
+    return (seqNm2chr, seqNm2orfs)
     
-def process_output(recordOffSetList, seqNm4offSet, output, datafile, maxhits, begMatch, endMatch, downloadFile):
+def process_output(recordOffSetList, seqNmList, output, datafile, maxhits, begMatch, endMatch, downloadFile):
 
     seqNm2length = {}
     if endMatch == 1:
-        set_seq_length(seqNm2length, datafile)
+        seqNm2length = load_cached(load_seq_length, datafile)
     
     name2data = {}
     if 'orf_' in datafile:
-        with open(dataDir + "locus.txt", encoding="utf-8") as f:
-            for line in f:
-                pieces = line.strip().split('\t')
-                seqName = pieces[0]
-                geneName = pieces[1]
-                sgdid = pieces[2]
-                desc = ''
-                if len(pieces) > 3:
-                    desc = pieces[3]
-                name2data[seqName] = (geneName, sgdid, desc)
+        name2data = load_cached(load_locus_data, dataDir + "locus.txt")
+
+    ## the dataset type doesn't change from one hit to the next
+    isNotFeature = 'Not' in datafile
 
     seqNm2chr = {}
     seqNm2orfs = {}
-    if 'Not' in datafile:
-        with open(datafile, encoding="utf-8") as f:
-            for line in f:
-                if line.startswith('>'):
-                    # >A:2170-2479, Chr I from 2170-2479, Genome Release 64-3-1, between YAL068C and YAL067W-A
-                    # /^>([^ ]+)\, Chr ([^ ]+) from .+ between ([^ ]+ and [^ ]+)/)
-                    pieces = line.strip().replace('>', '').split(' ')
-                    seqName = pieces[0].replace(',', '')
-                    chr = pieces[2]
-                    orfs = line.strip().split('between ')[1]
-                    seqNm2chr[seqName] = chr
-                    orfs = orfs.replace('and', '-')
-                    seqNm2orfs[seqName] = orfs;
+    if isNotFeature:
+        (seqNm2chr, seqNm2orfs) = load_cached(load_not_feature_data, datafile)
         
     data = []
 
     totalHits = 0
     uniqueHits = 0
-    hitCount4seqNm = {}
+    hitCount4seqNm = defaultdict(int)
 
     if maxhits is None:
         maxhits = DEFAULT_MAXHITS
@@ -355,90 +593,96 @@ def process_output(recordOffSetList, seqNm4offSet, output, datafile, maxhits, be
         # Log unexpected value of maxhits, if needed
         maxhits = DEFAULT_MAXHITS
     
-    for line in output.split('\n'):
-        
-        if line.startswith('['):
+    matchHit = hitLinePattern.match
+    for line in output:
 
-            line = line.replace('[', '').replace(']', '')
-            line = line.replace(':', '').replace(',', '')
-            pieces = line.split(' ')
-            if len(pieces) < 3:
-                continue
-            beg = int(pieces[0])
-            end = int(pieces[1])
-            matchingPattern = pieces[2]
-        
-            offSet = get_name_offset(beg, recordOffSetList);
-            if not str(offSet).isdigit():
-                continue
-            seqBeg = beg - offSet + 1
-            seqEnd = end - offSet
-            seqNm = seqNm4offSet.get(offSet, None)
-            if seqNm is None:
-                continue
-            if begMatch == 1 and seqBeg != 1:
-                continue
-            if endMatch == 1 and seqEnd != seqNm2length[seqNm]:
-                continue
-            if seqNm.startswith('>'):
-                ## match to the fasta header line 
-                continue
+        ## stop reading (and let the search be stopped) as soon as maxhits are kept
+        if totalHits >= maxhits:
+            break
 
-            if seqNm.endswith(','):
-                seqNm = seqNm.rstrip(seqNm[-1])
-                
-            if 'Not' in datafile:
-                # num = int(seqNm.split(':')[1].split('-')[0])
-                pieces = seqNm.split(':')
-                if len(pieces) < 2:
-                    continue
-                num = int(pieces[1].split('-')[0])
-                seqBeg = seqBeg + num -1
-                seqEnd = seqEnd + num -1
-                if seqNm not in seqNm2chr or seqNm not in seqNm2orfs:
-                    continue
+        ## nrgrep_coords hit lines look like "[14096, 14102]: GAATTC"
+        m = matchHit(line)
+        if m is None:
+            continue
+        beg = int(m.group(1))
+        end = int(m.group(2))
+        matchingPattern = m.group(3).decode()
+    
+        ## the record containing this hit starts at the closest offset <= beg
+        idx = bisect_right(recordOffSetList, beg) - 1
+        if idx < 0:
+            ## a hit ahead of the first header goes to the first record
+            idx = bisect_right(recordOffSetList, recordOffSetList[0]) - 1
+        offSet = recordOffSetList[idx]
+        seqBeg = beg - offSet + 1
+        seqEnd = end - offSet
+        if begMatch == 1 and seqBeg != 1:
+            continue
+        seqNm = seqNmList[idx]
+        if endMatch == 1 and seqEnd != seqNm2length[seqNm]:
+            continue
+        if seqNm.startswith('>'):
+            ## match to the fasta header line 
+            continue
 
-                row = str(seqNm2orfs.get(seqNm)) + "\t" + str(seqBeg) +  "\t" + str(seqEnd) + "\t" + matchingPattern + "\t" + str(seqNm2chr.get(seqNm)) + "\t" + seqNm
-                
-            else:
-                (gene, sgdid, desc) = name2data.get(seqNm, ('', '', ''))
-                row = seqNm + "\t" + str(seqBeg) + "\t" + str(seqEnd) + "\t" + matchingPattern + "\t" + gene + "\t" + sgdid + "\t" + desc
+        if seqNm.endswith(','):
+            seqNm = seqNm.rstrip(seqNm[-1])
+            
+        if isNotFeature:
+            # num = int(seqNm.split(':')[1].split('-')[0])
+            pieces = seqNm.split(':')
+            if len(pieces) < 2:
+                continue
+            num = int(pieces[1].split('-')[0])
+            seqBeg = seqBeg + num -1
+            seqEnd = seqEnd + num -1
+            if seqNm not in seqNm2chr or seqNm not in seqNm2orfs:
+                continue
 
-            if seqNm not in hitCount4seqNm:
-                uniqueHits = uniqueHits + 1
-            if totalHits >= maxhits:
-                break
+            row = (seqNm2orfs[seqNm], seqBeg, seqEnd, matchingPattern, seqNm2chr[seqNm], seqNm)
+            
+        else:
+            (gene, sgdid, desc) = name2data.get(seqNm, ('', '', ''))
+            row = (seqNm, seqBeg, seqEnd, matchingPattern, gene, sgdid, desc)
 
-            if seqNm in hitCount4seqNm:
-                hitCount4seqNm[seqNm] = hitCount4seqNm[seqNm] + 1
-            else:
-                hitCount4seqNm[seqNm] = 1
-            totalHits = totalHits + 1
+        if seqNm not in hitCount4seqNm:
+            uniqueHits = uniqueHits + 1
+        hitCount4seqNm[seqNm] += 1
+        totalHits = totalHits + 1
 
-            data.append(row)
+        data.append(row)
 
-    file_content = []
     header_line = ""
 
-    if 'Not' in datafile:
+    if isNotFeature:
         header_line = "Chromosome\tBetweenORFtoORF\tHitNumber\tMatchPattern\tMatchStartCoord\tMatchStopCoord\n"    
     elif 'orf_' in datafile:
         header_line = "Feature Name\tGene Name\tHitNumber\tMatchPattern\tMatchStartCoord\tMatchStopCoord\tLocusInfo\n"
     else:
         header_line = "Sequence Name\tHitNumber\tMatchPattern\tMatchStartCoord\tMatchStopCoord\n"
 
-    file_content.append(header_line)
-
     newData = []
 
+    ## rows are tuples, so coordinates sort numerically within each sequence
     data.sort()
 
     error_message = ''
+
+    ## the download file is written row by row as the hits are rendered
+    ## rather than collected in memory and written at the end
+    fw = None
+    try:
+        fw = open(downloadFile, "w", encoding='utf-8', buffering=1<<20)
+        fw.write(header_line)
+    except OSError as e:
+        error_message += "OS Error during file writing: " + str(e) + "\n"
     
     for row in data:
         try:
-            if 'Not' in datafile:
-                [orfs, beg, end, matchPattern, chr, seqNm] = row.split('\t')
+            if isNotFeature:
+                (orfs, beg, end, matchPattern, chr, seqNm) = row
+                beg = str(beg)
+                end = str(end)
                 count = hitCount4seqNm[seqNm]
                 orfs = orfs.strip()
                 newData.append({ 'orfs': orfs,
@@ -448,10 +692,12 @@ def process_output(recordOffSetList, seqNm4offSet, output, datafile, maxhits, be
                              'count': count,
                              'seqname': seqNm,
                              'matchingPattern': matchPattern })
-                line = chr + "\t" + orfs + "\t" + str(count) + "\t" + matchPattern + "\t" + beg + "\t" + end + "\n"
+                line = "\t".join((chr, orfs, str(count), matchPattern, beg, end)) + "\n"
             else:
 
-                [seqNm, beg, end, matchPattern, gene, sgdid, desc] = row.split('\t')
+                (seqNm, beg, end, matchPattern, gene, sgdid, desc) = row
+                beg = str(beg)
+                end = str(end)
         
                 count = hitCount4seqNm.get(seqNm, 0)
         
@@ -466,7 +712,7 @@ def process_output(recordOffSetList, seqNm4offSet, output, datafile, maxhits, be
                                  'gene_name': gene,
                                  'sgdid': sgdid,
                                  'desc': desc })
-                    line = seqNm + "\t" + gene + "\t" + str(count) + "\t" + matchPattern + "\t" + beg + "\t" + end + "\t" + desc + "\n"
+                    line = "\t".join((seqNm, gene, str(count), matchPattern, beg, end, desc)) + "\n"
                 else:
                     newData.append({ 'seqname': seqNm,
                                  'gene_name': gene,
@@ -476,8 +722,9 @@ def process_output(recordOffSetList, seqNm4offSet, output, datafile, maxhits, be
                                  'count': count,
                                  'matchingPattern': matchPattern,
                                  'desc': desc })
-                    line = seqNm + "\t" + str(count) + "\t" + matchPattern + "\t" + beg + "\t" + end + "\n"
-                file_content.append(line)
+                    line = "\t".join((seqNm, str(count), matchPattern, beg, end)) + "\n"
+            if fw is not None:
+                fw.write(line)
         except MemoryError as e:
             error_message += "Memory Error: " + str(e) + "\n"
             break
@@ -493,18 +740,12 @@ def process_output(recordOffSetList, seqNm4offSet, output, datafile, maxhits, be
             error_message += "Unexpected error for row: " + str(row) + "error: " + str(e) + "\n"
             error_message += "Traceback: " + str(traceback.format_exc()) + "\n"
             continue
-    try:
-        with open(downloadFile, "w", encoding='utf-8') as fw:
-            fw.writelines(file_content)
-    except MemoryError as e:
-        error_message += "Memory Error during file writing: " + str(e) + "\n"
-    except OSError as e:
-        error_message += "OS Error during file writing: " + str(e) + "\n"
-    except UnicodeEncodeError as e:
-        error_message += "Unicode Encoding Error: " + str(e) + "\n"
-    except Exception as e:
-        error_message += "Error writing to file " + downloadFile + ":" + str(e)
-        error_message += "Traceback: " + str(traceback.format_exc()) + "\n"
+
+    if fw is not None:
+        try:
+            fw.close()
+        except OSError as e:
+            error_message += "OS Error during file writing: " + str(e) + "\n"
 
     return (newData, uniqueHits, totalHits, error_message)
 
@@ -532,7 +773,9 @@ def run_patmatch(request, id):
         else:
             dataset = "orf_pep.seq"
 	
-    datafile = dataDir + dataset
+    datafile = resolve_path(dataDir, dataDir + dataset)
+    if datafile is None:
+        return { "error": "Unknown dataset: " + dataset }
 
     if seqname:
         data = get_sequence(datafile, seqname)
@@ -563,30 +806,27 @@ def run_patmatch(request, id):
 
     maxBufferSize = MAX_BUFFER_SIZE
     
-    nrgrep = searchScript + " -i -b " + str(maxBufferSize) + " -k " + option + " '" + pattern + "' '" + datafile + "'"
-    output = os.popen(nrgrep).read()
+    nrgrep = [searchScript, "-i", "-b", str(maxBufferSize), "-k", option, pattern, datafile]
+    commands = [nrgrep]
 
-    nrgrep2 = ''
-    output2 = ''
     if comp_pattern:
-        nrgrep2 = searchScript + " -i -b " +str( maxBufferSize) + " -k " + option + " '" + comp_pattern +"' '" + datafile + "'"
-        output2 = os.popen(nrgrep2).read()
-        output = output + "\n" + output2
+        nrgrep2 = [searchScript, "-i", "-b", str(maxBufferSize), "-k", option, comp_pattern, datafile]
+        commands.append(nrgrep2)
 
-    # return { "nrgrep": nrgrep,
-    #         "nrgrep2": nrgrep2,
-    #         "output": output }
-        
-    (recordOffSetList, seqNm4offSet) = get_record_offset(datafile)
+    output = run_search(commands)
+    try:
+        (recordOffSetList, seqNmList) = get_record_offset(datafile)
 
-    # return { "nrgrep": nrgrep,
-    #         "nrgrep2": nrgrep2,
-    #         "recordOffSetlist": recordOffSetList,
-    #         "seqNm4offSet": seqNm4offSet }
+        # return { "nrgrep": nrgrep,
+        #         "nrgrep2": nrgrep2,
+        #         "recordOffSetlist": recordOffSetList,
+        #         "seqNmList": seqNmList }
     
-    (data, uniqueHits, totalHits, error_message) = process_output(recordOffSetList, seqNm4offSet, output,
-                                                                  datafile, get_param(request, 'max_hits'),
-                                                                  begMatch, endMatch, downloadFile)
+        (data, uniqueHits, totalHits, error_message) = process_output(recordOffSetList, seqNmList, output,
+                                                                      datafile, get_param(request, 'max_hits'),
+                                                                      begMatch, endMatch, downloadFile)
+    finally:
+        output.close()
 
     downloadUrl = ''
     if uniqueHits > 0:
@@ -0,0 +1,277 @@
+import math
+import re
+from functools import lru_cache
+
+## Python port of bin/patmatch_to_nrgrep.pl, so converting a pattern does not
+## cost a perl process per request.  Converts a Patmatch pattern expression to
+## an expression understood by nrgrep.  Like the perl script it does not check
+## the syntax of the pattern; that is done before calling convert_pattern().
+##
+## Class options:
+## -n: assume nucleotide pattern
+## -p: assume protein pattern
+## -c: reverse complement nucleotide
+
+INFINITE = -1
+
+NUCLEOTIDE = 'N'
+PEPTIDE = 'P'
+COMPLEMENT = 'C'
+
+classes = { '-n': NUCLEOTIDE,
+            '-p': PEPTIDE,
+            '-c': COMPLEMENT }
+
+peptide_subsets = [('J', '[IFVLWMAGCY]'),
+                   ('O', '[TSHEDQNKR]'),
+                   ('B', '[DN]'),
+                   ('Z', '[EQ]')]
+
+nucleotide_subsets = [('R', '[AG]'),
+                      ('Y', '[CT]'),
+                      ('S', '[GC]'),
+                      ('W', '[AT]'),
+                      ('M', '[AC]'),
+                      ('K', '[GT]'),
+                      ('V', '[ACG]'),
+                      ('H', '[ACT]'),
+                      ('D', '[AGT]'),
+                      ('B', '[CGT]')]
+
+complement_table = str.maketrans('ATCGRYSWMKVHDB', 'TAGCYRSWKMBDHV')
+
+open_group_char = { ')': '(',
+                    ']': '[',
+                    '}': '{' }
+
+perl_number = re.compile(r'\s*[+-]?(\d+\.?\d*|\.\d+)([eE][+-]?\d+)?')
+
+
+## the conversion is a pure function of its arguments and the same patterns
+## come up again and again, so results are memoized
+@lru_cache(maxsize=4096)
+def convert_pattern(option, pattern):
+
+    if option not in classes:
+        return "Invalid class.\n"
+    seqclass = classes[option]
+
+    nrgrep_pattern = prepare_pattern(pattern, seqclass)
+    nrgrep_pattern = fix_wildcards(nrgrep_pattern, seqclass)
+    nrgrep_pattern = fix_repetitions(nrgrep_pattern)
+    nrgrep_pattern = sub_characters(nrgrep_pattern, seqclass)
+    nrgrep_pattern = finalize_pattern(nrgrep_pattern)
+    return nrgrep_pattern
+
+
+def prepare_pattern(pattern, seqclass):
+
+    ## make all characters upper case and remove spaces
+    pattern = re.sub(r'\s', '', pattern).upper()
+    if seqclass == COMPLEMENT:
+        pattern = get_reverse_complement(pattern)
+    return pattern
+
+
+def fix_wildcards(pattern, seqclass):
+
+    if seqclass == PEPTIDE:
+        return pattern.replace('X', '.')
+    return pattern.replace('N', '.').replace('X', '.')
+
+
+def fix_repetitions(pattern):
+
+    ## {m}, {m,}, {,m} and {m,n} are spelled out as nrgrep repetitions
+    if '{' not in pattern:
+        return pattern
+
+    nrgrep = []
+    for char in pattern:
+        if char == '}':
+            process_repitition(nrgrep)
+        else:
+            nrgrep.append(char)
+    return ''.join(nrgrep)
+
+
+def process_repitition(nrgrep):
+
+    rep_info = extract_repitition_information(nrgrep)
+    repeat_pattern = extract_repeat_pattern(nrgrep)
+    (lower, upper) = process_repeat_info(rep_info)
+    nrgrep.append(build_nrgrep_repeat(lower, upper, repeat_pattern))
+
+
+def extract_repitition_information(nrgrep):
+
+    rep_info = []
+    while nrgrep:
+        char = nrgrep.pop()
+        if char == '{':
+            break
+        rep_info.insert(0, char)
+    return ''.join(rep_info)
+
+
+def extract_repeat_pattern(nrgrep):
+
+    ## the unit being repeated is the last character or bracketed group,
+    ## e.g. ATG -> G, AT(TATA) -> (TATA), AT[TAG] -> [TAG]
+    if not nrgrep:
+        return ''
+    char = nrgrep.pop()
+    if char not in (')', ']'):
+        return char
+
+    right_bracket = char
+    left_bracket = '(' if char == ')' else '['
+    depth = 1
+    repeat = [char]
+    while depth > 0 and nrgrep:
+        char = nrgrep.pop()
+        repeat.insert(0, char)
+        if char == right_bracket:
+            depth = depth + 1
+        elif char == left_bracket:
+            depth = depth - 1
+    return ''.join(repeat)
+
+
+def to_number(value):
+
+    ## numeric value of a string the way perl would see it
+    m = perl_number.match(value)
+    return float(m.group(0)) if m else 0
+
+
+def process_repeat_info(repeat_info):
+
+    lower = 0
+    upper = 0
+    bounds = repeat_info.split(',')
+    if re.match(r',\d+', repeat_info):
+        upper = to_number(bounds[1])
+    elif re.search(r'\d+,$', repeat_info):
+        lower = to_number(bounds[0])
+        upper = INFINITE
+    elif re.fullmatch(r'\d+', repeat_info):
+        lower = int(repeat_info)
+        upper = int(repeat_info)
+    elif re.fullmatch(r'\d+,\d+', repeat_info):
+        lower = int(bounds[0])
+        upper = int(bounds[1])
+    return (lower, upper)
+
+
+def build_nrgrep_repeat(lower, upper, pattern):
+
+    repeats = pattern * max(math.ceil(lower), 0)
+    if upper == INFINITE:
+        return repeats + pattern + '*'
+    return repeats + (pattern + '?') * max(math.ceil(upper - lower), 0)
+
+
+def sub_characters(pattern, seqclass):
+
+    ## substitute IUPAC wildcard characters with subsets
+    subsets = peptide_subsets if seqclass == PEPTIDE else nucleotide_subsets
+    for (char, subset) in subsets:
+        pattern = pattern.replace(char, subset)
+    return remove_nested_brackets(pattern)
+
+
+def remove_nested_brackets(pattern):
+
+    ## e.g. TA[A[AG]] -> TA[AG] and TA[ATAG] -> TA[ATG]
+    after_pattern = []
+    depth = 0
+    seen = set()
+    for char in pattern:
+        if char == '[':
+            if depth == 0:
+                after_pattern.append(char)
+            depth = depth + 1
+        elif char == ']':
+            if depth > 0:
+                depth = depth - 1
+            if depth == 0:
+                after_pattern.append(char)
+                seen = set()
+        elif depth == 0:
+            after_pattern.append(char)
+        elif char not in seen:
+            after_pattern.append(char)
+            seen.add(char)
+    return ''.join(after_pattern)
+
+
+def finalize_pattern(pattern):
+
+    ## wrap the pattern in parentheses and turn < and > into nrgrep anchors
+    if pattern.startswith('<') and pattern.endswith('>'):
+        pattern = pattern.replace('<', '', 1).replace('>', '', 1)
+        return '^(' + pattern + ')$'
+    if pattern.startswith('<'):
+        return '^(' + pattern.replace('<', '', 1) + ')'
+    if pattern.endswith('>'):
+        return '(' + pattern.replace('>', '', 1) + ')$'
+    return '(' + pattern + ')'
+
+
+def get_reverse_complement(pattern):
+
+    return reverse_pattern(complement_nucleotides(pattern))
+
+
+def complement_nucleotides(pattern):
+
+    pattern = pattern.translate(complement_table)
+    if pattern.startswith('<'):
+        pattern = '>' + pattern[1:]
+    if pattern.endswith('>'):
+        pattern = pattern[:-1] + '<'
+    return pattern
+
+
+def reverse_pattern(pattern):
+
+    ## groups such as (...), [...] and x{m,n} keep their inner order markers
+    pat_array = list(pattern)
+    reverse = []
+    while pat_array:
+        char = pat_array.pop()
+        if char in (')', ']', '}'):
+            reverse.append(extract_group(char, pat_array))
+        else:
+            reverse.append(char)
+    return ''.join(reverse)
+
+
+def extract_group(closer, pat_array):
+
+    ## e.g. } and GG(CTA){2,3 -> (ATC){2,3} ; ) and GGCT(ATA[CT]A -> (A[TC]ATA)
+    opener = open_group_char[closer]
+    group_arr = [closer]
+    internal_group_chars = []
+    while pat_array:
+        char = pat_array.pop()
+        if char == opener:
+            if opener != '{':
+                group_arr.insert(0, ''.join(internal_group_chars))
+                group_arr.insert(0, char)
+            else:
+                group_arr.insert(0, char)
+                repeater = pat_array.pop() if pat_array else ''
+                if repeater in (']', ')'):
+                    group_arr.insert(0, extract_group(repeater, pat_array))
+                else:
+                    group_arr.insert(0, repeater)
+            break
+        elif char in (')', ']', '}'):
+            internal_group_chars.append(extract_group(char, pat_array))
+        elif closer == '}':
+            group_arr.insert(0, char)
+        else:
+            internal_group_chars.append(char)
+    return ''.join(group_arr)
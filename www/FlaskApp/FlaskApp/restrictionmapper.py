@@ -1,40 +1,90 @@
 import json
 import os
+import queue
 import re
-from patmatch import get_downloadUrl
+import string
+import subprocess
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from patmatch import get_downloadUrl, load_cached, load_index_file
 
 binDir = '/var/www/bin/'
 dataDir = '/data/restriction_mapper/'
 tmpDir = "/var/www/tmp/"
+## per-thread scratch files; the tmp sweep only removes files at the top
+## level of tmpDir, so files in here are never deleted under a request
+workspaceDir = tmpDir + "workspace/"
 
 scan4matches = binDir + "scan_for_matches"
 fastafile = dataDir + "orf_genomic.seq"
+maxSearchWorkers = os.cpu_count() or 4
+## enzyme headers written by do_search (">>EcoRI: 1 4 GAATTC") and
+## scan_for_matches hit lines (">YAL003W:[603,608]")
+outputLinePattern = re.compile(rb'^>>([^\s:]*):? (\S*) (\S*) (\S*)|^>[^:\n]*:\[(\d+),(\d+)\]', re.M)
+nonLetterBytes = bytes(c for c in range(256) if chr(c) not in string.ascii_letters)
+
+_workspace = threading.local()
 
 def get_downloadURLs(cutSiteFile, notCutFile):
 
     return (get_downloadUrl(cutSiteFile), get_downloadUrl(notCutFile))
+
+def get_workspace():
+
+    ## the pattern, output and sequence files are only scratch space, so each
+    ## worker thread reuses its own set (one pattern file per scan slot) and
+    ## every request truncates and rewrites them
+    if not hasattr(_workspace, 'files'):
+        os.makedirs(workspaceDir, exist_ok=True)
+        tag = str(os.getpid()) + "." + str(threading.get_ident())
+        patfiles = tuple(workspaceDir + "patfile." + tag + "." + str(i) + ".txt" for i in range(maxSearchWorkers))
+        outfile = workspaceDir + "outfile." + tag + ".txt"
+        seqfile = workspaceDir + "seqfile." + tag + ".txt"
+        _workspace.files = (patfiles, outfile, seqfile)
+    return _workspace.files
     
+def build_seq_index(datafile):
+
+    ## map every name a sequence can be looked up by (systematic name, gene
+    ## name and SGDID) to its defline and the byte range of its sequence line
+    index = {}
+    names = None
+    offset = 0
+    with open(datafile, "rb") as f:
+        for line in f:
+            if line.startswith(b'>'):
+                defline = line.decode().strip()
+                pieces = defline.split(' ', 3)
+                names = [pieces[0].replace('>', '')] + pieces[1:2] + [x.replace('SGDID:', '').replace(',', '') for x in pieces[2:3]]
+            elif names is not None and line.strip():
+                entry = (defline, offset, offset + len(line))
+                for x in names:
+                    index.setdefault(x.lower(), entry)
+                names = None
+            offset = offset + len(line)
+    return index
+
+def load_seq_index(datafile):
+
+    ## patmatch keeps a differently shaped index in <datafile>.idx.pkl, so
+    ## this one gets its own sidecar
+    return load_index_file(build_seq_index, datafile, datafile + ".names.idx.pkl")
+
 def get_sequence(name):
 
     name = name.replace('SGD:', '')
 
-    f = open(fastafile, encoding="utf-8")
-    
+    index = load_cached(load_seq_index, fastafile)
+
     seq = ""
     defline = ""
-    for line in f:
-        line = line.strip()
-        if line.startswith('>'):
-            pieces = line.split(' ')
-            if pieces[0].replace('>', '').lower() == name.lower() or pieces[1].lower() == name.lower() or pieces[2].replace('SGDID:', '').replace(',', '').lower() == name.lower():
-                defline = line
-            continue
-        elif defline != '':
-            seq = line
-        if seq != '':
-            break
-
-    f.close()
+    entry = index.get(name.lower())
+    if entry is not None:
+        (defline, beg, end) = entry
+        with open(fastafile, "rb") as f:
+            f.seek(beg)
+            seq = f.read(end - beg).decode().strip()
 
     defline = defline.replace('"', "'")
     
@@ -42,30 +92,31 @@ def get_sequence(name):
 
 def write_seqfile(defline, seq, seqfile):
     
-    fw = open(seqfile, "w")
+    ## remove all non-alphabet chars from seq string: non-ASCII chars are
+    ## dropped by the encode, the rest by one table-driven translate
+    seq = seq.encode('ascii', 'ignore').translate(None, nonLetterBytes)
 
-    ## remove all non-alphabet chars from seq string
-    regex = re.compile('[^a-zA-Z]')
-    seq = regex.sub('', seq)
-        
-    fw.write(defline + "\n")
-    fw.write(seq + "\n")
+    fw = open(seqfile, "wb")
+    fw.write(defline.encode() + b"\n" + seq + b"\n")
     fw.close()
 
     seqNm = "Unnamed"
     chrCoords = ""
     # >YAL067C SEO1 SGDID:S000000062, Chr I from 9016-7235, Genome Release ...
     if "SGDID:" in defline and 'Genome Release' in defline:
-        pieces = defline.replace('>', '').split(' ')
+        pieces = defline.replace('>', '').split(' ', 2)
         systematic_name = pieces[0]
         gene_name = pieces[1]
-        chrCoords = defline.split(', ')[1]
+        chrCoords = defline.split(', ', 2)[1]
         seqNm = systematic_name
         if gene_name:
             seqNm = gene_name + "/" + systematic_name
 
     return (seqNm, chrCoords, len(seq))
 
+## the frontend sends a handful of fixed type strings, so the routing is
+## worked out once per string
+@lru_cache(maxsize=64)
 def set_enzyme_file(enzymetype):
 
     if enzymetype is None:
@@ -85,38 +136,50 @@ def set_enzyme_file(enzymetype):
     
     return dataDir + 'rest_enzymes'
 
-def do_search(enzymefile, patfile, outfile, seqfile):
+def scan_enzyme(pat, patfiles, seq):
 
-    f = open(enzymefile, encoding="utf-8")
+    ## scan_for_matches takes one pattern per run, so a run borrows a free
+    ## pattern file, rewrites it, and hands it back once the scan is done
+    patfile = patfiles.get()
+    try:
+        fd = os.open(patfile, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        os.write(fd, (pat + "\n").encode())
+        os.close(fd)
 
-    ## reset file
-    fw = open(outfile, "w")
-    fw.close()
+        proc = subprocess.run([scan4matches, "-c", patfile], input=seq, stdout=subprocess.PIPE)
+    finally:
+        patfiles.put(patfile)
     
-    error_msg = ""
-    for line in f:
-
-        pieces = line.strip().split(' ')
-        enzyme = pieces[0]
-        offset = pieces[1]
-        pat = pieces[2]
-        overhang = pieces[3]
-        fw = open(patfile, "w")
-        fw.write(pat + "\n")
-        fw.close()
-        fw = open(outfile, "a")
-        fw.write(">>" + enzyme + ": " + str(offset) + " " + overhang + " " + pat + "\n")
+    return (proc.returncode, proc.stdout)
+
+def do_search(enzymefile, patfiles, outfile, seqfile):
+
+    enzymes = load_cached(load_enzymes, enzymefile)
+
+    ## read the sequence once and feed it to every run from memory
+    with open(seqfile, "rb") as fh:
+        seq = fh.read()
+
+    freePatfiles = queue.Queue()
+    for patfile in patfiles:
+        freePatfiles.put(patfile)
+
+    ## run the enzymes concurrently, then write their output in file order
+    with ThreadPoolExecutor(max_workers=len(patfiles)) as pool:
+        scans = [pool.submit(scan_enzyme, pat, freePatfiles, seq)
+                 for (enzyme, offset, pat, overhang) in enzymes]
+
+        error_msg = ""
+        fw = open(outfile, "wb")
+        for ((enzyme, offset, pat, overhang), scan) in zip(enzymes, scans):
+            fw.write((">>" + enzyme + ": " + str(offset) + " " + overhang + " " + pat + "\n").encode())
+            (err, output) = scan.result()
+            fw.write(output)
+            if err < 0:
+                error_msg = "RestrmictionMapper: problem running " + scan4matches + " returned " + str(err)
+                break
         fw.close()
 
-        cmd = scan4matches + " -c " + patfile + " < " + seqfile + " >> " + outfile
-        err = os.system(cmd)
-        
-        if err < 0: 
-            error_msg = "RestrmictionMapper: problem running " + scan4matches + " returned " + str(err)
-            break
-        
-    f.close()
-
     if error_msg:
         return error_msg
     
@@ -133,63 +196,77 @@ def set_enzyme_types(enzymeHash, enzymeType):
     elif '5' in enzymeType:
         enzymeFile = "rest_enzymes.5"
 
-    f = open(dataDir + enzymeFile, encoding="utf-8")
-    for line in f:
-        pieces = line.strip().split(' ')
-        enzymeHash[pieces[0]] = enzymeType
-    f.close()
+    enzymeHash.update(dict.fromkeys(load_cached(load_enzyme_names, dataDir + enzymeFile), enzymeType))
+
+def load_enzymes(enzymefile):
+
+    ## one "enzyme offset pattern overhang" line per enzyme; the file is
+    ## ASCII, so it is read in binary and decoded in one go
+    with open(enzymefile, "rb") as f:
+        lines = f.read().decode().split('\n')
+    return [tuple(line.strip().split(' ')[:4]) for line in lines if line.strip()]
+
+def load_enzyme_names(enzymefile):
+
+    return [enzyme[0] for enzyme in load_cached(load_enzymes, enzymefile)]
+
+def load_sorted_enzyme_names(enzymefile):
+
+    return sorted(set(load_cached(load_enzyme_names, enzymefile)))
     
-def process_data(seqLen, enzymetype, outfile, downloadfile4cutSite, downloadfile4notCut):
+def process_data(seqLen, enzymetype, enzymefile, outfile, downloadfile4cutSite, downloadfile4notCut):
 
     dataHash = {}
     offset = {}
     overhang = {}
     recognition_seq = {}
-    notCutEnzyme = []
+    notCutEnzyme = set()
     
-    f = open(outfile, encoding="utf-8") 
-    preLine = ''
+    ## an enzyme header followed directly by another header (or the end of
+    ## the file) is an enzyme without hits
+    listNotCut = enzymetype.lower() == 'all' or enzymetype == '' or enzymetype.lower().startswith('enzymes that do not')
+
+    ## watson strand hits are counted while parsing for the cut once/twice
+    ## filter; the crick count is the rest of the enzyme's hits
+    countCuts = "cut" in enzymetype
+    watsonCuts = {}
+
+    ## one regex pass over the whole output picks out the header and hit
+    ## lines and skips the matched sequence lines
+    with open(outfile, "rb") as f:
+        output = f.read()
     enzyme = ''
+    preHeader = False
     
-    for line in f:
-        if line.startswith('>>'):
-            pieces = line.strip().split(' ')
-            enzyme = pieces[0].replace('>>', '').replace(':', '')
-            offset[enzyme] = pieces[1]
-            overhang[enzyme] = pieces[2]
-            recognition_seq[enzyme] = pieces[3]
-            if enzymetype.lower() == 'all' or enzymetype == '' or enzymetype.lower().startswith('enzymes that do not'):
-                if preLine.startswith('>>'):
-                    pieces = preLine.replace('>>', '').replace(':', '').split(' ')
-                    if pieces[0] not in notCutEnzyme:
-                        notCutEnzyme.append(pieces[0])
-        elif line.startswith('>'):
-            # (/\>.+\[([0-9]+\,[0-9]+)\]$/) {
-            coords = line.strip().split(':')[1].replace('[', '').replace(']', '')
-            if enzyme in dataHash:
-                dataHash[enzyme] = dataHash[enzyme] + ':' + coords
-            else:
-                dataHash[enzyme] = coords 
-        preLine = line.strip()
-    
-    f.close()
-
-    if enzymetype.lower() == 'all' or enzymetype == '' or enzymetype.lower().startswith('enzymes that do not'):
-        if preLine.startswith('>>'):
-            pieces = preLine.replace('>>', '').replace(':', '').split(' ')
-            if pieces[0] not in	notCutEnzyme:
-                notCutEnzyme.append(pieces[0])
+    for m in outputLinePattern.finditer(output):
+        (name, off, ovh, pat, beg, end) = m.groups()
+        if name is not None:
+            if listNotCut and preHeader:
+                notCutEnzyme.add(enzyme)
+            enzyme = name.decode()
+            offset[enzyme] = off.decode()
+            overhang[enzyme] = ovh.decode()
+            recognition_seq[enzyme] = pat.decode()
+            preHeader = True
+            continue
+        preHeader = False
+        (beg, end) = (int(beg), int(end))
+        dataHash.setdefault(enzyme, []).append((beg, end))
+        if countCuts and beg < end:
+            watsonCuts[enzyme] = watsonCuts.get(enzyme, 0) + 1
+
+    if listNotCut and preHeader:
+        notCutEnzyme.add(enzyme)
                 
     fw = open(downloadfile4notCut, 'w')
-    notCutEnzyme.sort()
-    for enzyme in notCutEnzyme:
-        fw.write(enzyme + "\n")
+    notCutEnzyme = sorted(notCutEnzyme)
+    fw.write("".join(enzyme + "\n" for enzyme in notCutEnzyme))
     fw.close()
 
     if enzymetype.startswith('enzymes that do not'):
          return ({}, notCutEnzyme)
 
-    if "cut" in enzymetype:
+    if countCuts:
          
         cutLimit = 1
         if 'twice' in enzymetype:
@@ -197,17 +274,8 @@ def process_data(seqLen, enzymetype, outfile, downloadfile4cutSite, downloadfile
         
         newDataHash = {}
         for key in dataHash:
-            coords = dataHash[key].split(':')
-            wCut = 0
-            cCut = 0
-            for coordPair in coords:
-                [beg, end] = coordPair.split(',')
-                beg = int(beg)
-                end = int(end)
-                if beg < end: 
-                    wCut = wCut + 1
-                else:
-                    cCut = cCut + 1
+            wCut = watsonCuts.get(key, 0)
+            cCut = len(dataHash[key]) - wCut
             if (cCut == cutLimit and wCut <= cutLimit) or (wCut == cutLimit and cCut <= cutLimit):
                 newDataHash[key] = dataHash[key]
         dataHash = newDataHash
@@ -220,53 +288,37 @@ def process_data(seqLen, enzymetype, outfile, downloadfile4cutSite, downloadfile
 
     data = {}
 
-    fw = open(downloadfile4cutSite, 'w')
-    fw.write("Enzyme\toffset (bp)\toverhang (bp)\trecognition sequence\tenzyme type\tnumber of cuts\tordered fragment size\tsorted fragment size\tcut site on watson strand\tcut site on crick strand\n")
+    ## rows are collected and written out in one go
+    rows = []
+    rows.append("Enzyme\toffset (bp)\toverhang (bp)\trecognition sequence\tenzyme type\tnumber of cuts\tordered fragment size\tsorted fragment size\tcut site on watson strand\tcut site on crick strand\n")
 
-    for enzyme in sorted (dataHash):
+    ## the enzyme file is sorted once and its order reused for every search
+    for enzyme in load_cached(load_sorted_enzyme_names, enzymefile):
+        if enzyme not in dataHash:
+            continue
         if ("overhang" in enzymetype or "blunt" in enzymetype) and enzyme_type[enzyme] != enzymetype:
             continue
-        cutW = []
-        cutC = []
-        cutPositions = dataHash[enzyme].split(':')
-        cutAll = []
-        for position in cutPositions:
-            [beg, end] = position.split(',')
-            cutSite = None
-            beg = int(beg)
-            end = int(end)
-            if beg < end: # watson strand
-                cutSite = beg + int(offset[enzyme]) - 1
-                if cutSite not in cutW:
-                    cutW.append(cutSite)
-            else:  # crick strand
-                [beg, end] = [end, beg]            
-                # enzymeType = enzyme_type[enzyme]
-                cutSite = beg + int(offset[enzyme]) + int(overhang[enzyme]) - 1
-                if cutSite not in cutC:
-                    cutC.append(cutSite)
-            if cutSite not in cutAll:
-                cutAll.append(cutSite)
-        cutAll.append(seqLen)
+        ## compute the cut sites per strand in bulk; sets drop the duplicate sites
+        cutPositions = dataHash[enzyme]
+        watsonOffset = int(offset[enzyme]) - 1
+        crickOffset = int(offset[enzyme]) + int(overhang[enzyme]) - 1
+        cutW = { beg + watsonOffset for (beg, end) in cutPositions if beg < end }
+        cutC = { end + crickOffset for (beg, end) in cutPositions if beg >= end }
+        cutAll = cutW | cutC
+        cutAll.add(seqLen)
         
-        preCutSite = 0
-        found = {}
-        cutFragments = []
-
-        for cutSite in sorted(cutAll, key=int):
-            cutSize = cutSite - preCutSite
-            if cutSize != 0 and cutSize not in found:
-                cutFragments.append(cutSize)
-                found[cutSize] = 1
-            preCutSite = cutSite
-
-        cutSiteW = ", ".join([str(x) for x in sorted(cutW, key=int)])
-        cutSiteC = ", ".join([str(x) for x in sorted(cutC, key=int)])
+        ## one sort of all cut sites; the per-strand lists are read off it in order
+        cutAll = sorted(cutAll)
+        cutSizes = [cutSite - preCutSite for (preCutSite, cutSite) in zip([0] + cutAll, cutAll)]
+        cutFragments = list(dict.fromkeys(cutSize for cutSize in cutSizes if cutSize != 0))
+
+        cutSiteW = ", ".join([str(x) for x in cutAll if x in cutW])
+        cutSiteC = ", ".join([str(x) for x in cutAll if x in cutC])
         fragmentsReal = ", ".join([str(x) for x in cutFragments])
-        fragments = ", ".join([str(x) for x in sorted(cutFragments, key=int, reverse=True)])
+        fragments = ", ".join([str(x) for x in sorted(cutFragments, reverse=True)])
         cutNum = len(cutFragments) - 1
 
-        fw.write(enzyme + "\t" + str(offset[enzyme]) + "\t" + str(overhang[enzyme]) + "\t" + recognition_seq[enzyme] + "\t" + enzyme_type[enzyme] + "\t" + str(cutNum) + "\t" + fragmentsReal + "\t" + fragments + "\t" + cutSiteW + "\t" + cutSiteC + "\n")
+        rows.append("\t".join((enzyme, str(offset[enzyme]), str(overhang[enzyme]), recognition_seq[enzyme], enzyme_type[enzyme], str(cutNum), fragmentsReal, fragments, cutSiteW, cutSiteC)) + "\n")
 
         data[enzyme] =  {  "cut_site_on_watson_strand": cutSiteW,
                            "cut_site_on_crick_strand": cutSiteC,
@@ -277,6 +329,8 @@ def process_data(seqLen, enzymetype, outfile, downloadfile4cutSite, downloadfile
                            "recognition_seq": recognition_seq[enzyme],
                            "enzyme_type": enzyme_type[enzyme]  }
     
+    fw = open(downloadfile4cutSite, 'w')
+    fw.write("".join(rows))
     fw.close()
     
     return (data, notCutEnzyme)
@@ -284,9 +338,7 @@ def process_data(seqLen, enzymetype, outfile, downloadfile4cutSite, downloadfile
 
 def run_restriction_site_search(request, id):
 
-    patfile = tmpDir + "patfile." + id + ".txt"
-    outfile = tmpDir + "outfile." + id + ".txt"
-    seqfile = tmpDir + "seqfile." + id + ".txt"
+    (patfiles, outfile, seqfile) = get_workspace()
 
     cutSiteFile = "restrictionmapper." + id
     notCutFile = "restrictionmapper_not_cut_enzyme." + id
@@ -297,9 +349,9 @@ def run_restriction_site_search(request, id):
     p = request.args
     f = request.form
 
-    seq = f.get('seq') if f.get('seq') else p.get('seq')
-    name = f.get('name') if f.get('name') else p.get('name')
-    enzymetype = f.get('type') if f.get('type') else p.get('type', 'ALL')
+    seq = f.get('seq') or p.get('seq')
+    name = f.get('name') or p.get('name')
+    enzymetype = f.get('type') or p.get('type', 'ALL')
     enzymetype = enzymetype.replace('+', ' ').replace("%27", "'")
 
     defline = None
@@ -312,11 +364,11 @@ def run_restriction_site_search(request, id):
     
     enzymefile = set_enzyme_file(enzymetype)
     
-    err = do_search(enzymefile, patfile, outfile, seqfile)
+    err = do_search(enzymefile, patfiles, outfile, seqfile)
 
     if err == '':
         ## key is the enzyme
-        (data, notCutEnzymeList) = process_data(seqLen, enzymetype, outfile, downloadfile4cutSite, downloadfile4notCut)
+        (data, notCutEnzymeList) = process_data(seqLen, enzymetype, enzymefile, outfile, downloadfile4cutSite, downloadfile4notCut)
         (downloadUrl4cutSite, downloadUrl4notCut) = get_downloadURLs(cutSiteFile, notCutFile)
         
         return { "data": data,